@@ -12,16 +12,16 @@
 # specified offset, and outputs the processed image, mask, the
 # applied X and Y offsets, and a descriptive info string.
 #
-# Version: 1.1.1
+# Version: 1.2.0
 #
 # License: See LICENSE.txt
 #
 # ==========================================================================
 
 
+import functools
+
 import torch
-from PIL import Image, ImageOps, ImageChops
-import numpy as np
 
 # Define step values as variables 
 SMALL_STEP = 1
@@ -61,12 +61,17 @@ class EsesImageOffset:
     CATEGORY = "Eses Nodes/Image"
 
 
-    def _parse_color_string(self, color_string):
+    # Parsed colors are cached, the fill color
+    # rarely changes between workflow runs
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _parse_color_string(color_string):
         color_string = color_string.strip()
         if not color_string: return (0, 0, 0, 0)
         try:
-            if len(color_string) == 6: return tuple(int(color_string[i:i+2], 16) for i in (0, 2, 4)) + (255,)
-            if len(color_string) == 8: return tuple(int(color_string[i:i+2], 16) for i in (0, 2, 4, 6))
+            hex_bytes = bytes.fromhex(color_string)
+            if len(hex_bytes) == 3: return tuple(hex_bytes) + (255,)
+            if len(hex_bytes) == 4: return tuple(hex_bytes)
         except ValueError: pass
         try:
             parts = [int(p.strip()) for p in color_string.split(',')]
@@ -76,6 +81,125 @@ class EsesImageOffset:
         
         return (0, 0, 0, 0)
 
+    def _paste_slices(self, length, offset):
+        # Source and destination ranges along one axis when
+        # pasting content shifted by offset (clipped to the canvas)
+        dst_start = min(max(offset, 0), length)
+        dst_end = max(min(length, length + offset), dst_start)
+        return slice(dst_start - offset, dst_end - offset), slice(dst_start, dst_end)
+
+    def _fill_outside(self, canvas, dst_y, dst_x, value):
+        # Fill only the areas exposed by the offset, so every canvas
+        # pixel is written once (pasted content or fill, never both)
+        canvas[:, :dst_y.start] = value
+        canvas[:, dst_y.stop:] = value
+        canvas[:, dst_y, :dst_x.start] = value
+        canvas[:, dst_y, dst_x.stop:] = value
+
+    def _nearest_indices(self, src_length, dst_length):
+        # Source index for each output pixel, sampled at pixel centers
+        # and accumulated in floating point like PIL's NEAREST resize,
+        # so exact ties round the same way PIL does
+        scale = src_length / dst_length
+        position = scale * 0.5
+        indices = []
+        for _ in range(dst_length):
+            indices.append(min(int(position), src_length - 1))
+            position += scale
+        return indices
+
+    def _resize_mask_nearest(self, mask_t, height, width):
+        # Nearest neighbour resize, same as PIL NEAREST
+        rows = torch.tensor(self._nearest_indices(mask_t.shape[1], height), device=mask_t.device)
+        cols = torch.tensor(self._nearest_indices(mask_t.shape[2], width), device=mask_t.device)
+        return mask_t[:, rows.unsqueeze(1), cols]
+
+    def _output_info(self, offset_x, offset_y, width, height, wrap_around, invert_mask_output):
+        return f"Offset: ({offset_x}, {offset_y}), Size: {width}x{height}, Wrapped: {wrap_around}, Mask Output Inverted: {invert_mask_output}"
+
+    def _clamp_into(self, src, buffer):
+        # Clamp straight into the float32 buffer (single pass) when dtype
+        # and device already match, clamp.out can't convert the dtype
+        if src.dtype == buffer.dtype and src.device == buffer.device:
+            torch.clamp(src, 0.0, 1.0, out=buffer)
+        else:
+            buffer.copy_(src).clamp_(0.0, 1.0)
+        return buffer
+
+    def _prepare_mask(self, mask, device):
+        mask_t = self._clamp_into(mask, torch.empty(mask.shape, device=device))
+        if mask_t.dim() == 2:
+            mask_t = mask_t.unsqueeze(0)
+        return mask_t
+
+    def _wrap_shifts(self, offset_x, offset_y, width, height, wrap_around):
+        # Wrapping by whole multiples of the canvas
+        # size leaves the content where it is
+        if wrap_around == "On": return offset_x % width, offset_y % height
+        return offset_x, offset_y
+
+    def _offset_mask(self, mask_t, shift_x, shift_y, wrap_around, fill_value):
+        if wrap_around == "On": return torch.roll(mask_t, shifts=(shift_y, shift_x), dims=(1, 2))
+
+        src_y, dst_y = self._paste_slices(mask_t.shape[1], shift_y)
+        src_x, dst_x = self._paste_slices(mask_t.shape[2], shift_x)
+        temp_mask = torch.empty(mask_t.shape, device=mask_t.device)
+        temp_mask[:, dst_y, dst_x] = mask_t[:, src_y, src_x]
+        self._fill_outside(temp_mask, dst_y, dst_x, fill_value)
+        return temp_mask
+
+    def _offset_image(self, img_rgb, img_alpha, shift_x, shift_y, wrap_around, fill_rgba):
+        # The image alpha (if any) is a separate tensor
+        # and is shifted the same way as the color
+        if wrap_around == "On":
+            img_rgb = torch.roll(img_rgb, shifts=(shift_y, shift_x), dims=(1, 2))
+            if img_alpha is not None:
+                img_alpha = torch.roll(img_alpha, shifts=(shift_y, shift_x), dims=(1, 2))
+            return img_rgb, img_alpha
+
+        src_y, dst_y = self._paste_slices(img_rgb.shape[1], shift_y)
+        src_x, dst_x = self._paste_slices(img_rgb.shape[2], shift_x)
+        temp_rgb = torch.empty(img_rgb.shape, device=img_rgb.device)
+
+        # Paste the original image (which might have its own
+        # alpha) onto the fill_color background, using the
+        # image alpha as paste mask
+        src_rgb = img_rgb[:, src_y, src_x, :]
+        if img_alpha is None: temp_rgb[:, dst_y, dst_x, :] = src_rgb
+        else:
+            src_alpha = img_alpha[:, src_y, src_x]
+            temp_rgb[:, dst_y, dst_x, :] = torch.lerp(fill_rgba[:3], src_rgb, src_alpha.unsqueeze(-1))
+
+            # The alpha itself is pasted the same way
+            temp_alpha = torch.empty(img_alpha.shape, device=img_alpha.device)
+            temp_alpha[:, dst_y, dst_x] = torch.lerp(fill_rgba[3], src_alpha, src_alpha)
+            self._fill_outside(temp_alpha, dst_y, dst_x, fill_rgba[3])
+            img_alpha = temp_alpha
+
+        self._fill_outside(temp_rgb, dst_y, dst_x, fill_rgba[:3])
+        return temp_rgb, img_alpha
+
+    def _mask_only_path(self, offset_x, offset_y, wrap_around, invert_mask_output, mask):
+        # Only a mask is provided, there is no image work to do
+        mask_t = self._prepare_mask(mask, mask.device)
+        batch_size, current_height, current_width = mask_t.shape
+
+        shift_x, shift_y = self._wrap_shifts(offset_x, offset_y, current_width, current_height, wrap_around)
+        if shift_x != 0 or shift_y != 0:
+            mask_t = self._offset_mask(mask_t, shift_x, shift_y, wrap_around, 1.0)
+
+        # Output a black image, so nodes
+        # connected to IMAGE still get one
+        output_image = torch.zeros(batch_size, current_height, current_width, 3, device=mask.device)
+
+        # Output mask is 1.0 - input mask,
+        # unless the output is inverted
+        output_mask = mask_t if invert_mask_output == "Yes" else 1.0 - mask_t
+
+        output_info = self._output_info(offset_x, offset_y, current_width, current_height, wrap_around, invert_mask_output)
+
+        return (output_image, output_mask, offset_x, offset_y, output_info)
+
     def apply_image_transformations(self, offset_x, offset_y, wrap_around, fill_color, invert_mask_output, image=None, mask=None):
 
         if image is None and mask is None:
@@ -84,140 +208,136 @@ class EsesImageOffset:
             dummy_mask = torch.zeros(1, 64, 64)
             return (dummy_image, dummy_mask, offset_x, offset_y, "No Image or Mask Input")
 
+        if image is None:
+            return self._mask_only_path(offset_x, offset_y, wrap_around, invert_mask_output, mask)
+
+        # --- Pass-through ---
+
+        # Without an offset, an opaque image with no mask
+        # connected comes out unchanged, skip all the work
+        if offset_x == 0 and offset_y == 0 and mask is None and image.shape[-1] == 3:
+            batch_size, current_height, current_width = image.shape[:3]
+            mask_value = 0.0 if invert_mask_output == "Yes" else 1.0
+            output_mask = torch.full((batch_size, current_height, current_width), mask_value, device=image.device)
+            output_info = self._output_info(offset_x, offset_y, current_width, current_height, wrap_around, invert_mask_output)
+            return (image, output_mask, offset_x, offset_y, output_info)
+
         is_mask_connected = mask is not None
-        img_pil, mask_pil = None, None
-        current_width, current_height = 0, 0
-
-        # --- Initialize PIL images and dimensions ---
-        if image is not None:
-            img_mode = 'RGBA' if image.shape[-1] == 4 else 'RGB'
-            img_pil = Image.fromarray(np.clip(255. * image.cpu().numpy().squeeze(), 0, 255).astype(np.uint8), mode=img_mode)
-            
-            # Always convert to RGBA if a mask is connected 
-            # OR if the image itself already has an alpha channel
-            if img_pil.mode != 'RGBA':
-                img_pil = img_pil.convert('RGBA')
-            current_width, current_height = img_pil.size
-        
+
+        # Keep all work on the device the image lives on (e.g. CUDA)
+        device = image.device
+
+        # --- Initialize tensors and dimensions ---
+
+        # Color and alpha are kept as separate tensors. The working
+        # buffers are allocated once and the input is clamped into them.
+        img_rgb = torch.empty(*image.shape[:3], 3, device=device)
+        self._clamp_into(image[..., :3], img_rgb)
+        current_height, current_width = img_rgb.shape[1:3]
+
+        # Only an image with its own alpha channel has an alpha to work
+        # on, an image without one is fully opaque. The alpha is only
+        # needed to paste the image onto the fill color, or when no
+        # connected mask replaces it.
+        img_alpha = None
+        if image.shape[-1] >= 4 and (wrap_around == "Off" or not is_mask_connected):
+            img_alpha = torch.empty(image.shape[:3], device=device)
+            self._clamp_into(image[..., 3], img_alpha)
+
         if is_mask_connected:
-            mask_np = np.clip(mask.cpu().numpy().squeeze() * 255., 0, 255).astype(np.uint8)
-            mask_pil = Image.fromarray(mask_np, mode='L')
-            
-            # If only a mask is provided
-            if not img_pil: 
-                current_width, current_height = mask_pil.size
-        
-        elif image is not None:
-            # If no mask is connected but there's an 
-            # image, create a full white mask (fully opaque)
-            mask_pil = Image.new('L', (current_width, current_height), color=255)
+            mask_t = self._prepare_mask(mask, device)
+        else:
+            # If no mask is connected, create
+            # a full white mask (fully opaque)
+            mask_t = torch.ones(img_rgb.shape[0], current_height, current_width, device=device)
+
+        if mask_t.shape[1:3] != img_rgb.shape[1:3]:
+            mask_t = self._resize_mask_nearest(mask_t, current_height, current_width)
 
-        if img_pil and mask_pil and (img_pil.size != mask_pil.size):
-            mask_pil = mask_pil.resize(img_pil.size, Image.NEAREST)
+        # Whole batches are processed at once, a single image
+        # or mask is broadcast over the batch of the other
+        batch_size = mask_t.shape[0]
+        if img_rgb.shape[0] != batch_size:
+            batch_size = max(img_rgb.shape[0], batch_size)
+            if min(img_rgb.shape[0], mask_t.shape[0]) != 1:
+                raise ValueError(f"Image batch size {img_rgb.shape[0]} does not match mask batch size {mask_t.shape[0]}")
+            img_rgb = img_rgb.expand(batch_size, -1, -1, -1)
+            mask_t = mask_t.expand(batch_size, -1, -1)
+            if img_alpha is not None:
+                img_alpha = img_alpha.expand(batch_size, -1, -1)
 
 
         # --- Apply Offset ---
         unified_fill_color_tuple = self._parse_color_string(fill_color)
-        
-        if img_pil:
-            if wrap_around == "On": img_pil = ImageChops.offset(img_pil, offset_x, offset_y)
-            else:
-                temp_img = Image.new("RGBA", (current_width, current_height), unified_fill_color_tuple)
-                
-                # Paste the original image (which might 
-                # have its own alpha) onto the fill_color background
-                temp_img.paste(img_pil, (offset_x, offset_y), img_pil.split()[-1] if img_pil.mode == 'RGBA' else None); img_pil = temp_img
-        
-        if mask_pil:
-            # 255 if mask is connected, 0 if it's a dummy
-            mask_fill_value = 255 if is_mask_connected else 0 
-            
-            if wrap_around == "On": mask_pil = ImageChops.offset(mask_pil, offset_x, offset_y)
-            else:
-                temp_mask_img = Image.new('L', (current_width, current_height), color=mask_fill_value)
-                temp_mask_img.paste(mask_pil, (offset_x, offset_y)); mask_pil = temp_mask_img
+        fill_rgba = torch.tensor(unified_fill_color_tuple, dtype=torch.float32, device=device).div_(255.0).clamp_(0.0, 1.0)
+
+        # torch.roll shifts content the same way ImageChops.offset does,
+        # the non-wrapping variant pastes the shifted content on a canvas
+        shift_x, shift_y = self._wrap_shifts(offset_x, offset_y, current_width, current_height, wrap_around)
+
+        # Without an offset only pasting an image with its
+        # own alpha onto the fill color changes anything
+        has_offset = shift_x != 0 or shift_y != 0
+
+        if has_offset or (wrap_around == "Off" and img_alpha is not None):
+            img_rgb, img_alpha = self._offset_image(img_rgb, img_alpha, shift_x, shift_y, wrap_around, fill_rgba)
+
+        if has_offset:
+            # 1.0 if mask is connected, 0.0 if it's a dummy
+            mask_fill_value = 1.0 if is_mask_connected else 0.0
+            mask_t = self._offset_mask(mask_t, shift_x, shift_y, wrap_around, mask_fill_value)
 
-        
-        # --- Apply incoming mask to image's alpha channel ---
+
+        # --- Invert mask ---
+
+        # For a connected mask, (1.0 - mask) is both the alpha used
+        # for the image and the default output mask (ComfyUI typically
+        # treats white as masked, black as unmasked for output). The
+        # "invert_mask_output" toggle flips which of the two is output,
+        # so at most one subtraction is needed.
+        invert_output = invert_mask_output == "Yes"
+        inverted_mask = None
+        if is_mask_connected or invert_output:
+            inverted_mask = 1.0 - mask_t
+
+
+        # --- Use incoming mask as image's alpha ---
 
         # If an input mask is connected, use it to control transparency.
-        # We invert the mask here because a common convention 
-        # is that black in mask means 'visible' while 
-        # PIL's putalpha uses black for transparent.
-        if img_pil and is_mask_connected:
-            
-            # Ensure img_pil has an alpha channel 
-            # before applying the mask
-            if img_pil.mode != 'RGBA':
-                img_pil = img_pil.convert('RGBA')
-            
-            # Invert the mask for use as alpha, so black areas 
-            # in the input mask become opaque in the image
-            inverted_mask_for_alpha = ImageOps.invert(mask_pil)
-            img_pil.putalpha(inverted_mask_for_alpha)
+        # We use the inverted mask here because a common convention
+        # is that black in mask means 'visible' while
+        # alpha uses black for transparent.
+        src_alpha = inverted_mask if is_mask_connected else img_alpha
+
 
-        
         # --- Composite image over fill_color background ---
 
-        # This makes the fill_color appear behind the 
-        # transparent areas of the image and converts 
-        # the image back to 3 channels.
-        if img_pil:
-            
-            # Ensure the fill_color tuple has an opaque alpha
-            # (e.g., (R,G,B,255)) for a solid background
-            
-            # If user only provided RGB, ensure opaque alpha
-            if len(unified_fill_color_tuple) == 3: 
-                fill_color_for_composite = unified_fill_color_tuple + (255,)
-            
-            # Use the alpha provided by user, 
-            # or default (0,0,0,0) if parsing failed
-            else: 
-                fill_color_for_composite = unified_fill_color_tuple
-
-            # Create a new solid background image with the fill_color
-            background_img = Image.new("RGBA", img_pil.size, fill_color_for_composite)
-            
-            # Composite the (potentially transparent) img_pil onto the background
-            img_pil = Image.alpha_composite(background_img, img_pil)
-            
-            # After compositing, convert to RGB to flatten the image
-            img_pil = img_pil.convert("RGB")
-
-
-        # --- Invert Mask for output (if toggle is "Yes") ---
-
-        if mask_pil and invert_mask_output == "Yes":
-            mask_pil = ImageOps.invert(mask_pil)
-
-
-        # --- Convert back to torch tensors ---
-
-        # Output image is now 3-channel (RGB) 
-        # because it's composited with fill_color
-        output_image = torch.zeros(1, current_height, current_width, 3)
-        
-        if img_pil:
-            img_array = np.array(img_pil).astype(np.float32) / 255.0 # No need to convert to RGB here, it's already done
-            output_image = torch.from_numpy(img_array)[None,]
-
-        output_mask = torch.zeros(1, current_height, current_width)
-        if mask_pil:
-            mask_np_float = np.array(mask_pil).astype(np.float32) / 255.0
-            
-            # If an input mask was connected, the output mask 
-            # should be 1.0 - input mask (ComfyUI typically treats 
-            # white as masked, black as unmasked for output)
-            if is_mask_connected:
-                output_mask = 1.0 - mask_np_float
-            else:
-                # If no mask was connected, 
-                # just use the generated full mask
-                output_mask = mask_np_float 
-            
-            output_mask = torch.from_numpy(output_mask)[None,]
-
-        output_info = f"Offset: ({offset_x}, {offset_y}), Size: {current_width}x{current_height}, Wrapped: {wrap_around}, Mask Output Inverted: {invert_mask_output}"
+        # This makes the fill_color appear behind the
+        # transparent areas of the image ("over" operator,
+        # same as PIL's alpha_composite).
+        if src_alpha is None:
+            # Fully opaque, the fill color can't show through
+            output_image = img_rgb
+        else:
+            fill_rgb = fill_rgba[:3]
+            fill_alpha = min(max(unified_fill_color_tuple[3], 0), 255) / 255.0
+
+            # With an opaque fill the image alpha is the blend weight,
+            # a (semi-)transparent fill renormalizes it. Where both are
+            # fully transparent the fill color is kept, like PIL does.
+            blend_weight = src_alpha
+            if fill_alpha < 1.0:
+                blend_weight = src_alpha / (src_alpha + fill_alpha * (1.0 - src_alpha)).clamp(min=1e-6)
+
+            output_image = torch.lerp(fill_rgb, img_rgb, blend_weight.unsqueeze(-1))
+
+
+        # --- Output mask ---
+
+        # A generated mask (no mask connected) is output as is,
+        # unless the output is inverted
+        output_mask = inverted_mask if is_mask_connected != invert_output else mask_t.contiguous()
+
+        output_info = self._output_info(offset_x, offset_y, current_width, current_height, wrap_around, invert_mask_output)
         
         return (output_image, output_mask, offset_x, offset_y, output_info)
\ No newline at end of file